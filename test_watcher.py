@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+import watcher
+
+
+@pytest.fixture(autouse=True)
+def alerts(monkeypatch):
+    """Give every test its own watcher state; collect alert types instead of sending them"""
+    captured = []
+    monkeypatch.setattr(watcher, 'state', watcher.WatcherState())
+    monkeypatch.setattr(watcher, 'send_slack_alert', lambda message, alert_type="info": captured.append(alert_type))
+    return captured
+
+
+def log_line(pool, status, release='v1', addr='172.18.0.2:3000'):
+    return (
+        f'172.18.0.1 - - [15/Oct/2026:09:00:00 +0000] "GET /version HTTP/1.1" 200 57 "-" "curl/8.0" '
+        f'pool={pool} release={release} upstream_status={status} upstream_addr={addr} '
+        f'request_time=0.003 upstream_response_time=0.003'
+    ).encode()
+
+
+def test_parse_retried_request_keeps_first_attempt():
+    line = log_line('green', '502, 200', addr='172.18.0.2:3000, 172.18.0.3:3000')
+    assert watcher.parse_log_line(line) == ('green', 'v1', 502, '172.18.0.2:3000')
+
+
+def test_parse_skips_line_without_pool():
+    line = log_line('-', '502, 502', release='-', addr='172.18.0.2:3000, 172.18.0.3:3000')
+    assert watcher.parse_log_line(line) is None
+
+
+def test_line_without_pool_is_ignored(alerts):
+    watcher.process_lines([
+        log_line('blue', '200'),
+        log_line('-', '502, 502', release='-'),
+        log_line('blue', '200'),
+    ])
+    
+    assert alerts == []
+    assert watcher.state.last_pool == 'blue'
+    assert watcher.state.window_filled == 2
+    assert watcher.state.error_count == 0
+
+
+def test_parse_ignores_pool_in_client_controlled_fields():
+    line = log_line('blue', '200').replace(b'GET /version ', b'GET /version?pool=green ')
+    line = line.replace(b'"curl/8.0"', b'"curl/8.0 pool=green release=x upstream_status=500 upstream_addr=1:1"')
+    assert watcher.parse_log_line(line) == ('blue', 'v1', 200, '172.18.0.2:3000')
+
+
+def test_parse_rejects_pool_outside_word_syntax():
+    # Neither the fast path nor LOG_PATTERN accepts anything but a \w+ pool
+    line = log_line('blue-2', '200')
+    assert watcher.parse_log_line(line) is None
+
+
+@pytest.mark.parametrize('status, retried', [(429, True), (500, False), (502, False), (503, False), (504, False)])
+def test_slack_post_retried_only_when_rate_limited(status, retried):
+    retry = watcher.slack_session.get_adapter('https://hooks.slack.com').max_retries
+    assert retry.is_retry('POST', status, has_retry_after=True) is retried
+
+
+def test_read_new_lines_holds_partial_line_until_newline(tmp_path):
+    path = tmp_path / 'access.log'
+    path.write_bytes(b'first\nsec')
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    buf = bytearray()
+    try:
+        assert watcher.read_new_lines(fd, buf) == [b'first']
+        
+        with open(path, 'ab') as f:
+            f.write(b'ond\nthird\n')
+        assert watcher.read_new_lines(fd, buf) == [b'second', b'third']
+        
+        # Truncation under the reader just yields no data instead of faulting
+        os.truncate(path, 0)
+        assert watcher.read_new_lines(fd, buf) == []
+    finally:
+        os.close(fd)
+
+
+def test_error_count_matches_window_popcount(monkeypatch):
+    monkeypatch.setattr(watcher, 'WINDOW_SIZE', 7)
+    statuses = [200, 500, 502, 404, 599, 200, 503, 301, 500, 200, 504, 200, 200, 200, 200, 200, 502]
+    
+    for n, status in enumerate(statuses, 1):
+        watcher.record_status(status)
+        window = statuses[max(0, n - 7):n]
+        assert watcher.state.error_count == watcher.state.window_bits.bit_count()
+        assert watcher.state.error_count == sum(s >= 500 for s in window)
+        assert watcher.state.window_filled == len(window)
+
+
+@pytest.mark.parametrize('window_size, threshold, expected', [
+    (200, '2.0', 4),
+    (200, '2', 4),
+    (750, '9.2', 69),
+    (1250, '4.56', 57),
+    (625, '9.12', 57),
+    (1000, '0.7', 7),
+    (300, '0.7', 2),
+    # Non-finite thresholds keep the float comparison's meaning instead of failing
+    (200, 'inf', 200),
+    (200, 'nan', 200),
+    (200, '-inf', -1),
+])
+def test_error_count_threshold_is_exact(window_size, threshold, expected):
+    assert watcher.error_count_threshold(window_size, threshold) == expected
+
+
+def test_window_exactly_at_threshold_does_not_alert(alerts, monkeypatch):
+    monkeypatch.setattr(watcher, 'WINDOW_SIZE', 750)
+    monkeypatch.setattr(watcher, 'ERROR_COUNT_THRESHOLD', watcher.error_count_threshold(750, '9.2'))
+    
+    # 69 errors in 750 requests is exactly 9.2%, which is not above the threshold
+    for i in range(750):
+        watcher.record_status(500 if i >= 750 - 69 else 200)
+    watcher.check_error_rate(now=1e9)
+    assert alerts == []
+    
+    # Evicts a 200, leaving 70 errors in the window
+    watcher.record_status(500)
+    watcher.check_error_rate(now=1e9)
+    assert alerts == ['error']
+
+
+def test_lines_read_from_file_go_through_process_lines(tmp_path, alerts):
+    path = tmp_path / 'access.log'
+    path.write_bytes(b'\n'.join([
+        log_line('blue', '200'),
+        log_line('green', '502, 200', addr='172.18.0.2:3000, 172.18.0.3:3000'),
+        b'',
+    ]))
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        watcher.process_lines(watcher.read_new_lines(fd, bytearray()))
+    finally:
+        os.close(fd)
+    
+    assert alerts == ['failover']
+    assert watcher.state.last_pool == 'green'
+    assert watcher.state.error_count == 1
@@ -5,136 +5,385 @@ Sends alerts to Slack when thresholds are breached
 """
 
 import os
-import re
 import time
 import json
+import math
+import logging
+import ctypes
+import select
+import queue
+import struct
+import sys
+import threading
 import requests
-from collections import deque
-from datetime import datetime
+from dataclasses import dataclass
+from fractions import Fraction
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    json_encode = orjson.dumps
+except ImportError:
+    def json_encode(value):
+        return json.dumps(value).encode()
+
+try:
+    # Linear-time DFA matcher; the stdlib backtracking engine is the fallback
+    import re2 as re
+except ImportError:
+    import re
+
+def error_count_threshold(window_size, threshold):
+    """Largest 5xx count a full window can hold without exceeding threshold percent
+    
+    threshold is the decimal text from the environment. It is converted exactly,
+    because float rounding can move the boundary by one (e.g. 750 * 9.2 / 100).
+    """
+    rate = float(threshold)
+    if not math.isfinite(rate):
+        # No rate is above inf or nan; every rate is above -inf
+        return -1 if rate < 0 else window_size
+    return math.floor(Fraction(threshold) * window_size / 100)
 
 # Configuration from environment
 SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL', '')
-ERROR_RATE_THRESHOLD = float(os.getenv('ERROR_RATE_THRESHOLD', '2.0'))
+ERROR_RATE_THRESHOLD_TEXT = os.getenv('ERROR_RATE_THRESHOLD', '2.0')
+ERROR_RATE_THRESHOLD = float(ERROR_RATE_THRESHOLD_TEXT)
 WINDOW_SIZE = int(os.getenv('WINDOW_SIZE', '200'))
 ALERT_COOLDOWN_SEC = int(os.getenv('ALERT_COOLDOWN_SEC', '300'))
 LOG_FILE = '/var/log/nginx/access.log'
 
-# State tracking
-last_pool = None
-last_failover_alert = 0
-last_error_rate_alert = 0
-request_window = deque(maxlen=WINDOW_SIZE)
+# WINDOW_SIZE never changes after startup, so fold the percentage scale once
+FULL_WINDOW_RATE_SCALE = 100.0 / WINDOW_SIZE
+# A full window is over ERROR_RATE_THRESHOLD exactly when it holds more 5xx than this
+ERROR_COUNT_THRESHOLD = error_count_threshold(WINDOW_SIZE, ERROR_RATE_THRESHOLD_TEXT)
+READ_CHUNK_SIZE = 65536
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Per-request tracing goes through logging so it costs nothing unless LOG_LEVEL=DEBUG
+logger = logging.getLogger('watcher')
+
+# inotify event masks (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+SLACK_HEADERS = {'Content-Type': 'application/json'}
+
+class SlackRetry(Retry):
+    """Retry policy that honours Retry-After only on 429, not urllib3's default 413/503"""
+    RETRY_AFTER_STATUS_CODES = frozenset({429})
+
+# Shared HTTP session so bursts of alerts reuse one keep-alive TLS connection
+slack_session = requests.Session()
+slack_session.headers.update(SLACK_HEADERS)
+slack_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    # Only retry when Slack can't have accepted the message: failed connects and 429
+    # rate limiting. A 5xx or read timeout may follow delivery, so resending would
+    # duplicate the alert; those are left to the worker to log.
+    max_retries=SlackRetry(
+        total=2,
+        connect=2,
+        read=0,
+        other=0,
+        status=2,
+        backoff_factor=0.2,
+        status_forcelist=(429,),
+        allowed_methods=frozenset({'POST'}),
+        respect_retry_after_header=True,
+    ),
+))
+
+# Slack header (emoji, title) per alert type
+ALERT_META = {
+    "failover": ("🔄", "FAILOVER"),
+    "error": ("🚨", "ERROR"),
+    "recovery": ("✅", "RECOVERY"),
+    "info": ("ℹ️", "INFO"),
+}
+ALERT_HEADER_FMT = "%s *%s*"
+ALERT_TIMESTAMP_FMT = "Timestamp: %s UTC"
+# Fixed Slack message layout; slots take already JSON-encoded header, message, timestamp
+ALERT_PAYLOAD_TMPL = (
+    b'{"text":%s,"blocks":['
+    b'{"type":"section","text":{"type":"mrkdwn","text":%s}},'
+    b'{"type":"context","elements":[{"type":"mrkdwn","text":%s}]}'
+    b']}'
+)
+
+# Alerts are posted from a background thread so the log loop never waits on Slack
+alert_queue = queue.Queue(maxsize=128)
+
+@dataclass(slots=True)
+class WatcherState:
+    """Mutable watcher state, kept in slots for cheap attribute access per log line"""
+    last_pool: str = None
+    # time.monotonic() of the last alert sent, per alert kind
+    last_failover_alert: float = float('-inf')
+    last_error_rate_alert: float = float('-inf')
+    dropped_alerts: int = 0
+    
+    # Sliding window of the last WINDOW_SIZE requests, one bit per request (1 = 5xx)
+    window_bits: int = 0
+    window_head: int = 0  # Next bit position to overwrite
+    window_filled: int = 0  # Number of requests seen so far, capped at WINDOW_SIZE
+    error_count: int = 0  # Number of set bits in window_bits
+    above_threshold: bool = False  # Whether the last full-window check was over the threshold
+    
+    # Last formatted UTC timestamp and the epoch second it was formatted for
+    timestamp_second: int = -1
+    timestamp_text: str = ''
+
+state = WatcherState()
+
+# Interned pool names keyed by their raw log bytes, so pools compare by identity
+pool_names = {}
 
-# Log parsing regex
+# Log parsing regex (fallback for lines the fast parser can't handle)
 LOG_PATTERN = re.compile(
-    r'pool=(?P<pool>\w+) '
-    r'release=(?P<release>[\w\-\.]+) '
-    r'upstream_status=(?P<upstream_status>\d+)'
+    rb'pool=(\w+) '
+    rb'release=([\w\-\.]+) '
+    rb'upstream_status=(\d+)'
+    rb'(?:, [^ ]+)* '
+    rb'upstream_addr=([\d\.:]+)'
 )
 
+def intern_pool(raw):
+    """Return the single shared str for a raw pool name"""
+    pool = pool_names.get(raw)
+    if pool is None:
+        pool = pool_names[raw] = sys.intern(raw.decode())
+    return pool
+
+def parse_log_line(line):
+    """Extract (pool, release, upstream_status, upstream_addr) from a raw log line
+    
+    Lines where no upstream response carried X-App-Pool (nginx logs `pool=-`) are
+    skipped, as the regex parser always did.
+    """
+    # The log_format fields are the last ones on the line, so search from the end:
+    # earlier matches may come from the client-controlled request URI or User-Agent
+    m = line.rfind(b' upstream_addr=')
+    k = line.rfind(b' upstream_status=', 0, m) if m >= 0 else -1
+    j = line.rfind(b' release=', 0, k) if k >= 0 else -1
+    i = line.rfind(b' pool=', 0, j) if j >= 0 else -1
+    if i >= 0:
+        raw_pool = line[i + 6:j]
+        if raw_pool == b'-':
+            return None
+        
+        # Retried requests log a comma-separated list; keep the first attempt
+        status = line[k + 17:m]
+        comma = status.find(b',')
+        if comma >= 0:
+            status = status[:comma]
+        n = line.find(b' ', m + 15)
+        addr = line[m + 15:] if n < 0 else line[m + 15:n]
+        # Anything but LOG_PATTERN's \w+ pool syntax is left for the regex to judge
+        if status.isdigit() and raw_pool.replace(b'_', b'').isalnum():
+            return intern_pool(raw_pool), line[j + 9:k].decode(), int(status), addr.rstrip(b',').decode()
+    
+    match = LOG_PATTERN.search(line)
+    if not match:
+        return None
+    
+    return (
+        intern_pool(match.group(1)),
+        match.group(2).decode(),
+        int(match.group(3)),
+        match.group(4).decode(),
+    )
+
+def utc_timestamp():
+    """Current UTC time as text, reformatted only when the second changes"""
+    second = int(time.time())
+    if second != state.timestamp_second:
+        state.timestamp_second = second
+        state.timestamp_text = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))
+    return state.timestamp_text
+
+def post_slack_alerts():
+    """Worker thread: deliver queued alert payloads to the Slack webhook"""
+    while True:
+        payload, alert_type = alert_queue.get()
+        try:
+            response = slack_session.post(SLACK_WEBHOOK_URL, data=payload, timeout=10)
+            response.raise_for_status()
+            print(f"✅ Slack alert sent: {alert_type}")
+        except Exception as e:
+            print(f" Failed to send Slack alert: {e}")
+        finally:
+            alert_queue.task_done()
+
 def send_slack_alert(message, alert_type="info"):
-    """Send alert to Slack webhook"""
+    """Queue an alert for delivery to the Slack webhook"""
     if not SLACK_WEBHOOK_URL:
         print(f"⚠️  No Slack webhook configured. Alert: {message}")
         return
     
-    emoji = {
-        "failover": "🔄",
-        "error": "🚨",
-        "recovery": "✅",
-        "info": "ℹ️"
-    }.get(alert_type, "📊")
-    
-    payload = {
-        "text": f"{emoji} *{alert_type.upper()}*",
-        "blocks": [
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": message
-                }
-            },
-            {
-                "type": "context",
-                "elements": [
-                    {
-                        "type": "mrkdwn",
-                        "text": f"Timestamp: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC"
-                    }
-                ]
-            }
-        ]
-    }
+    meta = ALERT_META.get(alert_type)
+    if meta is None:
+        meta = ("📊", alert_type.upper())
+    payload = ALERT_PAYLOAD_TMPL % (
+        json_encode(ALERT_HEADER_FMT % meta),
+        json_encode(message),
+        json_encode(ALERT_TIMESTAMP_FMT % utc_timestamp()),
+    )
     
     try:
-        response = requests.post(
-            SLACK_WEBHOOK_URL,
-            json=payload,
-            headers={'Content-Type': 'application/json'},
-            timeout=10
-        )
-        response.raise_for_status()
-        print(f"✅ Slack alert sent: {alert_type}")
-    except Exception as e:
-        print(f" Failed to send Slack alert: {e}")
+        alert_queue.put_nowait((payload, alert_type))
+    except queue.Full:
+        state.dropped_alerts += 1
+        print(f" Slack alert queue full, dropped {alert_type} alert ({state.dropped_alerts} dropped so far)")
 
-def check_failover(pool):
+def check_failover(pool, now):
     """Detect and alert on pool failover"""
-    global last_pool, last_failover_alert
-    
-    if last_pool is None:
-        last_pool = pool
+    if state.last_pool is None:
+        state.last_pool = pool
         print(f"ℹ️  Initial pool: {pool}")
         return
     
-    if pool != last_pool:
+    if pool is not state.last_pool:
         # Check cooldown
-        now = time.time()
-        if now - last_failover_alert < ALERT_COOLDOWN_SEC:
+        if now - state.last_failover_alert < ALERT_COOLDOWN_SEC:
             print(f"⏳ Failover detected but in cooldown period")
             return
         
         # Failover detected!
         message = (
-            f"*Failover Detected: {last_pool.upper()} → {pool.upper()}*\n\n"
-            f"• Previous Pool: `{last_pool}`\n"
+            f"*Failover Detected: {state.last_pool.upper()} → {pool.upper()}*\n\n"
+            f"• Previous Pool: `{state.last_pool}`\n"
             f"• Current Pool: `{pool}`\n"
-            f"• Time: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC\n\n"
-            f"*Action Required:* Check health of {last_pool} container"
+            f"• Time: {utc_timestamp()} UTC\n\n"
+            f"*Action Required:* Check health of {state.last_pool} container"
         )
         
         send_slack_alert(message, "failover")
-        last_pool = pool
-        last_failover_alert = now
+        state.last_pool = pool
+        state.last_failover_alert = now
 
-def check_error_rate():
-    """Check if error rate exceeds threshold"""
-    global last_error_rate_alert
+def record_status(status):
+    """Append a status to the sliding window, keeping error_count in sync"""
+    bit = status // 100 == 5  # 5xx without a branch; bool is 0/1 in the arithmetic below
+    old_bit = (state.window_bits >> state.window_head) & 1
+    # Flip the slot only if it changes: one XOR instead of clear-then-set
+    state.window_bits ^= (old_bit ^ bit) << state.window_head
+    state.window_head = (state.window_head + 1) % WINDOW_SIZE
     
-    if len(request_window) < WINDOW_SIZE:
+    if state.window_filled < WINDOW_SIZE:
+        state.window_filled += 1
+    state.error_count += bit - old_bit
+
+def calculate_error_rate():
+    """Percentage of 5xx responses in the current window"""
+    if state.window_filled == WINDOW_SIZE:
+        return state.error_count * FULL_WINDOW_RATE_SCALE
+    return 100.0 * state.error_count / state.window_filled if state.window_filled else 0.0
+
+def check_error_rate(now):
+    """Check if error rate exceeds threshold"""
+    if state.window_filled < WINDOW_SIZE:
         return  # Not enough data yet
     
-    error_count = sum(1 for status in request_window if status >= 500)
-    error_rate = (error_count / len(request_window)) * 100
+    # Integer compare against the precomputed count; the rate is only needed for alerts
+    if state.error_count <= ERROR_COUNT_THRESHOLD:
+        if state.above_threshold:
+            state.above_threshold = False
+            print(f"✅ Error rate back under threshold: {calculate_error_rate():.2f}%")
+        return
     
-    if error_rate > ERROR_RATE_THRESHOLD:
-        # Check cooldown
-        now = time.time()
-        if now - last_error_rate_alert < ALERT_COOLDOWN_SEC:
-            return
+    state.above_threshold = True
+    
+    # Check cooldown
+    if now - state.last_error_rate_alert < ALERT_COOLDOWN_SEC:
+        return
+    
+    error_rate = calculate_error_rate()
+    message = (
+        f"*High Error Rate Alert*\n\n"
+        f"• Error Rate: `{error_rate:.2f}%` (threshold: {ERROR_RATE_THRESHOLD}%)\n"
+        f"• 5xx Errors: `{state.error_count}/{state.window_filled}` requests\n"
+        f"• Window Size: `{WINDOW_SIZE}` requests\n\n"
+        f"*Action Required:* Inspect upstream logs and consider toggling pools"
+    )
+    
+    send_slack_alert(message, "error")
+    state.last_error_rate_alert = now
+    print(f"🚨 High error rate: {error_rate:.2f}%")
+
+def inotify_watch(path, mask):
+    """Create an inotify instance watching path for the given event mask"""
+    inotify_fd = libc.inotify_init1(0)
+    if inotify_fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+    
+    if libc.inotify_add_watch(inotify_fd, os.fsencode(path), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(inotify_fd)
+        raise OSError(errno, f"inotify_add_watch failed on {path}: {os.strerror(errno)}")
+    
+    return inotify_fd
+
+def read_inotify_events(inotify_fd):
+    """Drain pending inotify events, yielding (mask, name) pairs"""
+    data = os.read(inotify_fd, READ_CHUNK_SIZE)
+    offset = 0
+    while offset < len(data):
+        _, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        name = data[offset:offset + name_len].rstrip(b'\0')
+        offset += name_len
+        yield mask, name
+
+def read_new_lines(fd, buf):
+    """Read everything appended since the last call and return complete lines"""
+    while True:
+        chunk = os.read(fd, READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buf += chunk
+    
+    end = buf.rfind(b'\n')
+    if end < 0:
+        return []
+    
+    # Hand out bytes, not bytearray slices: parsed fields are used as dict keys
+    lines = bytes(buf[:end]).split(b'\n')
+    del buf[:end + 1]
+    return lines
+
+def process_lines(lines):
+    """Parse a batch of raw log lines and run the alert checks for each"""
+    # Bind the per-line helpers once per batch instead of looking up globals per line
+    parse, record, failover, error_rate = parse_log_line, record_status, check_failover, check_error_rate
+    # One clock read per batch; monotonic so wall-clock jumps can't skew cooldowns
+    now = time.monotonic()
+    trace = logger.isEnabledFor(logging.DEBUG)
+    
+    for line in lines:
+        parsed = parse(line)
+        if parsed is None:
+            continue
         
-        message = (
-            f"*High Error Rate Alert*\n\n"
-            f"• Error Rate: `{error_rate:.2f}%` (threshold: {ERROR_RATE_THRESHOLD}%)\n"
-            f"• 5xx Errors: `{error_count}/{len(request_window)}` requests\n"
-            f"• Window Size: `{WINDOW_SIZE}` requests\n\n"
-            f"*Action Required:* Inspect upstream logs and consider toggling pools"
-        )
+        pool, release, upstream_status, _ = parsed
+        
+        # Track request status
+        record(upstream_status)
+        
+        # Check for failover
+        failover(pool, now)
+        
+        # Check error rate
+        error_rate(now)
         
-        send_slack_alert(message, "error")
-        last_error_rate_alert = now
-        print(f"🚨 High error rate: {error_rate:.2f}%")
+        if trace:
+            logger.debug("📝 Request: pool=%s, release=%s, status=%d", pool, release, upstream_status)
 
 def tail_log_file():
     """Tail the Nginx log file and process entries"""
@@ -148,37 +397,48 @@ def tail_log_file():
     
     print(f"✅ Log file found: {LOG_FILE}")
     
-    with open(LOG_FILE, 'r') as f:
-        # Seek to end of file
-        f.seek(0, 2)
-        
+    if SLACK_WEBHOOK_URL:
+        threading.Thread(target=post_slack_alerts, name='slack-alerts', daemon=True).start()
+    
+    # Watch the directory rather than the file so logrotate's rename/create is seen
+    log_name = os.fsencode(os.path.basename(LOG_FILE))
+    inotify_fd = inotify_watch(os.path.dirname(LOG_FILE), IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+    
+    fd = os.open(LOG_FILE, os.O_RDONLY | os.O_NONBLOCK)
+    # Seek to end of file
+    os.lseek(fd, 0, os.SEEK_END)
+    buf = bytearray()
+    
+    try:
         while True:
-            line = f.readline()
-            if not line:
-                time.sleep(0.1)
-                continue
-            
-            # Parse log line
-            match = LOG_PATTERN.search(line)
-            if not match:
-                continue
-            
-            pool = match.group('pool')
-            release = match.group('release')
-            upstream_status = int(match.group('upstream_status'))
+            # Block until the kernel reports activity in the log directory
+            select.select([inotify_fd], [], [])
             
-            # Track request status
-            request_window.append(upstream_status)
+            rotated = False
+            for mask, name in read_inotify_events(inotify_fd):
+                if name == log_name and mask & (IN_CREATE | IN_MOVED_TO):
+                    rotated = True
             
-            # Check for failover
-            check_failover(pool)
+            # copytruncate-style rotation shrinks the file under us
+            if os.fstat(fd).st_size < os.lseek(fd, 0, os.SEEK_CUR):
+                os.lseek(fd, 0, os.SEEK_SET)
+                buf.clear()
             
-            # Check error rate
-            check_error_rate()
+            # Finish whatever is left in the current file before switching
+            process_lines(read_new_lines(fd, buf))
             
-            print(f"📝 Request: pool={pool}, release={release}, status={upstream_status}")
+            if rotated:
+                print(f"🔁 Log file rotated, reopening: {LOG_FILE}")
+                os.close(fd)
+                fd = os.open(LOG_FILE, os.O_RDONLY | os.O_NONBLOCK)
+                buf.clear()
+                process_lines(read_new_lines(fd, buf))
+    finally:
+        os.close(fd)
+        os.close(inotify_fd)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL, format='%(message)s')
     print("🚀 Nginx Log Watcher Starting...")
     try:
         tail_log_file()